@@ -4,12 +4,18 @@
 """Unit Tests for custom rnns."""
 
 import numpy as np
+from onnx import TensorProto
 import tensorflow as tf
 
 from tensorflow.python.ops import init_ops
 from backend_test_base import Tf2OnnxBackendTestBase
 from common import *  # pylint: disable=wildcard-import, unused-wildcard-import
-from tf2onnx.tf_loader import is_tf2
+from tf2onnx.graph import Graph
+from tf2onnx.rewriter.custom_rnn_rewriter import CustomRnnRewriter
+from tf2onnx.rewriter.loop_rewriter_base import LoopVariable
+from tf2onnx.tf_loader import is_tf2, tf_reset_default_graph, tf_session
+from tf2onnx.tfonnx import graphs_from_tf
+from tf2onnx.utils import is_tf_loopcond_op
 
 
 # pylint: disable=missing-docstring,invalid-name,unused-argument,using-constant-test
@@ -69,6 +75,74 @@ class CustomRnnCellTests(Tf2OnnxBackendTestBase):
         output_names_with_port = ["output:0", "final_state:0"]
         self.run_test_case(func, feed_dict, input_names_with_port, output_names_with_port, 0.1)
 
+    @check_opset_min_version(8, "Scan")
+    @skip_tf2()
+    def test_single_dynamic_custom_rnn_single_step(self):
+        size = 5
+        batch_size = 6
+        x_val = np.array([[1., 1.]], dtype=np.float32)
+        x_val = np.stack([x_val] * batch_size)
+        def func(x):
+            cell = GatedGRUCell(size)
+            xs, s = dynamic_rnn(cell=cell, dtype=tf.float32, inputs=x, time_major=False)
+            return tf.identity(xs, name="output"), tf.identity(s, name="final_state")
+
+        feed_dict = {"input_1:0": x_val}
+        input_names_with_port = ["input_1:0"]
+        output_names_with_port = ["output:0", "final_state:0"]
+        # the only step is computed by the cell nodes directly, without a Scan
+        self.run_test_case(func, feed_dict, input_names_with_port, output_names_with_port, 0.1,
+                           graph_validator=lambda g: check_op_count(g, "Scan", 0, disabled=False))
+
+    @check_opset_min_version(8, "Scan")
+    @skip_tf2()
+    def test_single_dynamic_custom_rnn_input_projection(self):
+        size = 5
+        batch_size = 4
+        x_val = np.array([[1., 1.], [2., 2.], [3., 3.]], dtype=np.float32)
+        x_val = np.stack([x_val] * batch_size)
+        def func(x):
+            cell = GatedGRUCell(size)
+            xs, s = dynamic_rnn(cell=cell, dtype=tf.float32, inputs=x, time_major=False)
+            return tf.identity(xs, name="output"), tf.identity(s, name="final_state")
+
+        def validate(g):
+            # x_t * W + b is computed for all time steps by one MatMul and Add outside of Scan,
+            # only state * U is left in the scan body
+            outer_op_types = [n.type for n in g.get_nodes()]
+            return outer_op_types.count("MatMul") == 1 and outer_op_types.count("Add") == 1 \
+                and check_op_count(g, "MatMul", 2, disabled=False) and check_op_count(g, "Gemm", 0, disabled=False)
+
+        feed_dict = {"input_1:0": x_val}
+        input_names_with_port = ["input_1:0"]
+        output_names_with_port = ["output:0", "final_state:0"]
+        self.run_test_case(func, feed_dict, input_names_with_port, output_names_with_port, 0.1,
+                           graph_validator=validate)
+
+    @check_opset_min_version(8, "Scan")
+    @skip_tf2()
+    def test_single_dynamic_custom_rnn_input_projection_transpose_b(self):
+        size = 5
+        batch_size = 4
+        x_val = np.array([[1., 1.], [2., 2.], [3., 3.]], dtype=np.float32)
+        x_val = np.stack([x_val] * batch_size)
+        def func(x):
+            cell = GatedGRUCell(size, transpose_weights=True)
+            xs, s = dynamic_rnn(cell=cell, dtype=tf.float32, inputs=x, time_major=False)
+            return tf.identity(xs, name="output"), tf.identity(s, name="final_state")
+
+        def validate(g):
+            # the projection with transpose_b is not hoisted, both projections stay in the scan body
+            outer_op_types = [n.type for n in g.get_nodes()]
+            body_projections = len(group_nodes_by_type(g)["MatMul"]) + len(group_nodes_by_type(g)["Gemm"])
+            return "MatMul" not in outer_op_types and "Add" not in outer_op_types and body_projections == 2
+
+        feed_dict = {"input_1:0": x_val}
+        input_names_with_port = ["input_1:0"]
+        output_names_with_port = ["output:0", "final_state:0"]
+        self.run_test_case(func, feed_dict, input_names_with_port, output_names_with_port, 0.1,
+                           graph_validator=validate)
+
     @check_opset_min_version(8, "Scan")
     @skip_tf2()
     def test_single_dynamic_custom_rnn_with_seq_length(self):
@@ -91,6 +165,34 @@ class CustomRnnCellTests(Tf2OnnxBackendTestBase):
         output_names_with_port = ["output:0", "cell_state:0"]
         self.run_test_case(func, feed_dict, input_names_with_port, output_names_with_port, rtol=1e-06)
 
+    @check_opset_min_version(8, "Scan")
+    @skip_tf2()
+    def test_single_dynamic_custom_rnn_with_full_seq_length(self):
+        units = 5
+        batch_size = 6
+        x_val = np.array([[1., 1.], [2., 2.], [3., 3.], [4., 4.], [5., 5.]], dtype=np.float32)
+        x_val = np.stack([x_val] * batch_size)
+        def func(x):
+            # no scope
+            cell = GatedGRUCell(units)
+            outputs, cell_state = dynamic_rnn(
+                cell,
+                x,
+                dtype=tf.float32,
+                sequence_length=[5, 5, 5, 5, 5, 5])
+            return tf.identity(outputs, name="output"), tf.identity(cell_state, name="cell_state")
+
+        feed_dict = {"input_1:0": x_val}
+        input_names_with_port = ["input_1:0"]
+        output_names_with_port = ["output:0", "cell_state:0"]
+        # sequence_length never masks a step, so the check is folded out of the scan body. Before opset 12
+        # the check is converted to Less and Not, and the Select on it to a Cast/Not/Mul chain.
+        def validate(g):
+            return all(check_op_count(g, op_type, 0, disabled=False)
+                       for op_type in ["GreaterOrEqual", "Less", "Not", "Cast"])
+        self.run_test_case(func, feed_dict, input_names_with_port, output_names_with_port, rtol=1e-06,
+                           graph_validator=validate)
+
     @check_opset_min_version(8, "Scan")
     @skip_tf2()
     def test_single_dynamic_custom_rnn_with_non_const_seq_length(self):
@@ -375,12 +477,119 @@ class CustomRnnCellTests(Tf2OnnxBackendTestBase):
         output_names_with_port = ["output_0:0", "final_state:0"]
         self.run_test_case(func, feed_dict, input_names_with_port, output_names_with_port, 0.1)
 
+    @check_opset_min_version(8, "Scan")
+    @skip_tf2()
+    def test_loop_rewriter_finds_ta_input_of_optimized_graph(self):
+        # after tf optimization the switch of the time variable has several consumers, the loop
+        # rewriter running first on the graph inserts an Identity for them and must still find the
+        # tensor array read behind it.
+        x_val = np.array([[1., 1.], [2., 2.], [3., 3.]], dtype=np.float32)
+        x_val = np.stack([x_val] * 2)
+        def func(x):
+            xs, s = dynamic_rnn(cell=GatedGRUCell(5), dtype=tf.float32, inputs=x)
+            return tf.identity(xs, name="output"), tf.identity(s, name="final_state")
+
+        feed_dict = {"input_1:0": x_val}
+        output_names_with_port = ["output:0", "final_state:0"]
+        _, context = self._parse_single_loop(func, feed_dict, output_names_with_port)
+        self.assertEqual(len(context.loop_properties.tensor_array_inputs), 1)
+
+    @check_opset_min_version(9, "Scan")
+    @skip_tf2()
+    def test_single_dynamic_custom_rnn_with_read_last_history(self):
+        x_val = np.array([[1., 1.], [2., 2.], [3., 3.]], dtype=np.float32)
+        x_val = np.stack([x_val] * 2)
+        def func(x):
+            cell = HistoryCell(GatedGRUCell(5))
+            history = tf.TensorArray(tf.float32, size=3, element_shape=[2, 5])
+            initial_state = (tf.zeros([2, 5]), tf.constant(0), history)
+            xs, s = dynamic_rnn(cell=cell, dtype=tf.float32, inputs=x, initial_state=initial_state)
+            # the last written element of the history is the final state
+            return tf.identity(xs, name="output"), tf.identity(s[2].read(2), name="last_history")
+
+        feed_dict = {"input_1:0": x_val}
+        input_names_with_port = ["input_1:0"]
+        output_names_with_port = ["output:0", "last_history:0"]
+        self.run_test_case(func, feed_dict, input_names_with_port, output_names_with_port, 0.1,
+                           graph_validator=lambda g: (check_op_count(g, "Scan", 1, disabled=False) and
+                                                      check_op_count(g, "Loop", 0, disabled=False)))
+
+    @check_opset_min_version(9, "Scan")
+    @skip_tf2()
+    def test_custom_rnn_skips_read_last_history_without_state(self):
+        x_val = np.array([[1., 1.], [2., 2.], [3., 3.]], dtype=np.float32)
+        x_val = np.stack([x_val] * 2)
+        def func(x):
+            # the history doesn't hold the state, so its last element can't be taken from a scan state output
+            cell = HistoryCell(GatedGRUCell(5), scale=2.)
+            history = tf.TensorArray(tf.float32, size=3, element_shape=[2, 5])
+            initial_state = (tf.zeros([2, 5]), tf.constant(0), history)
+            xs, s = dynamic_rnn(cell=cell, dtype=tf.float32, inputs=x, initial_state=initial_state)
+            return tf.identity(xs, name="output"), tf.identity(s[2].read(2), name="last_history")
+
+        feed_dict = {"input_1:0": x_val}
+        output_names_with_port = ["output:0", "last_history:0"]
+        rewriter, context = self._parse_single_loop(func, feed_dict, output_names_with_port)
+        self.assertEqual(len(context.loop_properties.unneeded_scan_variables), 1)
+        self.assertFalse(rewriter.need_rewrite(context))
+
+    def test_fold_seq_len_check_folds_every_check(self):
+        g = Graph([], opset=self.config.opset)
+        g.make_const("time_init", np.array(0, dtype=np.int32))
+        g.make_const("step", np.array(1, dtype=np.int32))
+        g.make_const("seq_len", np.array([5, 5], dtype=np.int32))
+        body_g = g.create_new_graph_with_same_config()
+        body_g.parent_graph = g
+        body_g.add_graph_input("time", TensorProto.INT32, [])
+        body_g.add_graph_input("new_h", TensorProto.FLOAT, [2, 3])
+        body_g.add_graph_input("zeros", TensorProto.FLOAT, [2, 3])
+        body_g.make_node("Add", ["time", "step"], outputs=["time_next"], name="time_next",
+                         shapes=[[]], dtypes=[TensorProto.INT32])
+        # two always False checks next to each other in the body, each with its own Select
+        for i in range(2):
+            body_g.make_node("GreaterEqual", ["time", "seq_len"], outputs=[f"ge{i}"], name=f"ge{i}",
+                             shapes=[[2]], dtypes=[TensorProto.BOOL])
+        for i in range(2):
+            body_g.make_node("Select", [f"ge{i}", "zeros", "new_h"], outputs=[f"sel{i}"], name=f"sel{i}",
+                             shapes=[[2, 3]], dtypes=[TensorProto.FLOAT])
+            body_g.make_node("Identity", [f"sel{i}"], outputs=[f"out{i}"], name=f"out{i}",
+                             shapes=[[2, 3]], dtypes=[TensorProto.FLOAT])
+
+        context = CustomRnnRewriter(g).create_context()
+        context.time_var = LoopVariable("time_enter", "time_merge", "time_init", "time_next", "time",
+                                        None, None, None, body_g)
+        CustomRnnRewriter(g)._fold_seq_len_check(context, body_g, 3)  # pylint: disable=protected-access
+
+        body_op_types = [n.type for n in body_g.get_nodes()]
+        self.assertNotIn("GreaterEqual", body_op_types)
+        self.assertNotIn("Select", body_op_types)
+        for i in range(2):
+            self.assertEqual(body_g.get_node_by_output(f"out{i}").input[0], "new_h")
+
+    def _parse_single_loop(self, func, feed_dict, output_names_with_port):
+        """Parse the loop of the tf-optimized graph of func as the custom rnn rewriter would do."""
+        _, graph_def, _ = self.freeze_and_run_tf(func, feed_dict, output_names_with_port, False, False, False)
+        tf_reset_default_graph()
+        with tf_session() as sess:
+            tf.import_graph_def(graph_def, name='')
+            g, _ = graphs_from_tf(sess.graph, list(feed_dict), output_names_with_port)
+        g.set_config(opset=self.config.opset)
+
+        rewriter = CustomRnnRewriter(g)
+        loop_cond_ops = [op for op in g.get_nodes() if is_tf_loopcond_op(op)]
+        self.assertEqual(len(loop_cond_ops), 1)
+        context = rewriter.create_context()
+        context.loop_cond = loop_cond_ops[0]
+        rewriter._check_in_read_only_mode(context)  # pylint: disable=protected-access
+        return rewriter, context
+
 
 class GatedGRUCell(RNNCell):
-    def __init__(self, hidden_dim, reuse=None):
+    def __init__(self, hidden_dim, reuse=None, transpose_weights=False):
         super().__init__(self, _reuse=reuse)
         self._num_units = hidden_dim
         self._activation = tf.tanh
+        self._transpose_weights = transpose_weights
 
     @property
     def state_size(self):
@@ -407,7 +616,10 @@ class GatedGRUCell(RNNCell):
         # b = tf.get_variable(name='b', shape=[1, 3 * self._num_units], dtype=tf.float32)
         b = np.arange(15.0, dtype=np.float32).reshape((1, 15))
 
-        xw = tf.split(tf.matmul(inputs, W) + b, 3, 1)
+        if self._transpose_weights:
+            xw = tf.split(tf.matmul(inputs, W.T, transpose_b=True) + b, 3, 1)
+        else:
+            xw = tf.split(tf.matmul(inputs, W) + b, 3, 1)
         hu = tf.split(tf.matmul(state, U), 3, 1)
         r = tf.sigmoid(xw[0] + hu[0])
         z = tf.sigmoid(xw[1] + hu[1])
@@ -416,5 +628,28 @@ class GatedGRUCell(RNNCell):
         return next_h, next_h
 
 
+class HistoryCell(RNNCell):
+    """Wraps a cell and records its (scaled) state of each step in a TensorArray kept in the state."""
+    def __init__(self, cell, scale=None):
+        super().__init__()
+        self._cell = cell
+        self._scale = scale
+
+    @property
+    def state_size(self):
+        return (self._cell.state_size, tf.TensorShape([]), self._cell.state_size)
+
+    @property
+    def output_size(self):
+        return self._cell.output_size
+
+    def call(self, inputs, state):
+        cell_state, step, history = state
+        output, next_state = self._cell(inputs, cell_state)
+        recorded = next_state if self._scale is None else next_state * self._scale
+        history = history.write(step, recorded)
+        return output, (next_state, step + 1, history)
+
+
 if __name__ == '__main__':
     unittest_main()
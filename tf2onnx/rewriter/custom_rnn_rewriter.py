@@ -16,6 +16,7 @@ from tf2onnx.graph_builder import GraphBuilder
 from tf2onnx.rewriter.loop_rewriter_base import LoopRewriterBase, Context
 from tf2onnx.rewriter.rnn_utils import REWRITER_RESULT, get_rnn_scope_name, parse_rnn_loop
 from tf2onnx import utils
+from tf2onnx.utils import TensorValueInfo
 
 logger = logging.getLogger(__name__)
 
@@ -29,15 +30,23 @@ class CustomRnnContext(Context):
         self.rnn_scope = None
         self.time_var = None
         self.iteration_var = None
+        self.scan_length = -1
 
 
 class CustomRnnRewriter(LoopRewriterBase):
+    def __init__(self, g):
+        super(CustomRnnRewriter, self).__init__(g)
+        # target shape consts of scan input/output Reshapes, shared by identical shapes within self.g
+        self._shape_const_cache = {}
+
     def create_context(self):
         return CustomRnnContext()
 
     def run(self):
         logger.debug("enter custom rnn rewriter")
-        return self.run_internal()
+        # since opset 9, loops reading only the last element of a tensor array are kept for Scan as well,
+        # instead of falling through to the generic Loop rewriter.
+        return self.run_internal(allow_ta_read_last=self.g.opset >= 9)
 
     def need_rewrite(self, context):
         context.rnn_scope = get_rnn_scope_name(context.while_context_scope)
@@ -48,12 +57,20 @@ class CustomRnnRewriter(LoopRewriterBase):
             logger.debug("skip the loop due to parse_rnn_loop failed")
             return False
 
+        for unneeded_scan_variable in context.loop_properties.unneeded_scan_variables.values():
+            if not unneeded_scan_variable.equivalent_state_variable:
+                logger.debug("skip the loop due to tensor array read last has no equivalent state variable")
+                return False
+
         time_var, iteration_var = res
         context.time_var = time_var
         context.iteration_var = iteration_var
-        logger.debug("time var %s - enter input id (%s) shape: %s, output (%s) shape: %s", time_var.enter_name,
-                     time_var.enter_input_id, self.g.get_shape(time_var.enter_input_id),
-                     time_var.switch_true_identity_output.id, time_var.switch_true_identity_output.shape)
+        context.scan_length = self._get_scan_length(context.loop_properties.scan_inputs_initial_values)
+        if logger.isEnabledFor(logging.DEBUG):
+            # shape lookups are only worth doing when the message is emitted
+            logger.debug("time var %s - enter input id (%s) shape: %s, output (%s) shape: %s", time_var.enter_name,
+                         time_var.enter_input_id, self.g.get_shape(time_var.enter_input_id),
+                         time_var.switch_true_identity_output.id, time_var.switch_true_identity_output.shape)
 
         return True
 
@@ -61,38 +78,27 @@ class CustomRnnRewriter(LoopRewriterBase):
         logger.debug("enter rewrite function")
         try:
             scan_props = context.loop_properties
-
-            state_inputs_initial_values = []
-            for state_input in scan_props.state_inputs_initial_values:
-                if self.g.opset == 8:
-                    nodes = self._adapt_scan_sequence_input_or_output("input", state_input, False)
-                    state_inputs_initial_values.append(nodes[-1].output[0])
-                else:  # since opset 9
-                    state_inputs_initial_values.append(state_input)
-
-            scan_inputs_initial_values = []
-            scan_length = -1
-            for scan_input in scan_props.scan_inputs_initial_values:
-                if self.g.opset == 8:
-                    nodes = self._adapt_scan_sequence_input_or_output("input", scan_input, False)
-                    scan_inputs_initial_values.append(nodes[-1].output[0])
-                else:  # since opset 9
-                    scan_inputs_initial_values.append(scan_input)
-                scan_shape = self.g.get_shape(scan_input)
-                if scan_shape is not None and len(scan_shape) > 0:
-                    scan_length = scan_shape[0]
+            if context.scan_length == 1:
+                # a single step doesn't need to be iterated, the cell is kept in the graph instead of a Scan
+                self._inline_single_step(context)
+                return REWRITER_RESULT.OK
 
             cell_g_info = context.cell_graph
             scan_body_g = LoopRewriterBase.construct_graph_from_nodes(self.g, cell_g_info.nodes, cell_g_info.outputs)
-            for input_tensor_info in scan_props.state_inputs:
-                scan_body_g.add_graph_input(input_tensor_info.id, input_tensor_info.dtype, input_tensor_info.shape)
+            self._hoist_scan_input_projections(context, scan_body_g)
 
-            for input_tensor_info in scan_props.scan_inputs:
+            init_values = scan_props.state_inputs_initial_values + scan_props.scan_inputs_initial_values
+            if self.g.opset == 8:
+                init_values = [self._adapt_scan_sequence_input_or_output("input", init_value, False).output[0]
+                               for init_value in init_values]
+            # since opset 9, initial values are fed to Scan as they are
+
+            scan_length = context.scan_length
+            for input_tensor_info in scan_props.state_inputs + scan_props.scan_inputs:
                 scan_body_g.add_graph_input(input_tensor_info.id, input_tensor_info.dtype, input_tensor_info.shape)
+            self._fold_seq_len_check(context, scan_body_g, scan_length)
 
-            scan_node = self._create_scan_node(context, scan_props,
-                                               state_inputs_initial_values + scan_inputs_initial_values,
-                                               scan_body_g, scan_length)
+            scan_node = self._create_scan_node(context, scan_props, init_values, scan_body_g, scan_length)
             if not scan_node:
                 logger.error("failed to create scan node during rewrite")
                 return REWRITER_RESULT.FAIL
@@ -106,10 +112,172 @@ class CustomRnnRewriter(LoopRewriterBase):
             logger.error("custom rnn rewrite failed, due to exception: %s, details:%s", ex, tb)
             return REWRITER_RESULT.FAIL
 
+    def _get_scan_length(self, scan_inputs_initial_values):
+        scan_length = -1
+        for scan_input in scan_inputs_initial_values:
+            scan_shape = self.g.get_shape(scan_input)
+            if scan_shape is not None and len(scan_shape) > 0:
+                scan_length = scan_shape[0]
+        return scan_length
+
+    def _inline_single_step(self, context):
+        """Connect the cell nodes, which are still in self.g, as one iteration of the scan would do:
+        state inputs are their initial values, scan inputs are the only element of the sequences,
+        and the cell outputs are the final states and one element sequences.
+        """
+        logger.debug("inline the cell of single step rnn %s", context.rnn_scope)
+        loop_props = context.loop_properties
+        gb = GraphBuilder(self.g)
+        cell_inputs = {}
+        for state_input, init_value in zip(loop_props.state_inputs, loop_props.state_inputs_initial_values):
+            if state_input.id:
+                cell_inputs[state_input.id] = init_value
+        for input_ta in loop_props.tensor_array_inputs:
+            cell_inputs[input_ta.consumer.id] = gb.make_squeeze({"data": input_ta.data_input_id, "axes": [0]})
+        for cell_input_id, value_id in cell_inputs.items():
+            self.g.replace_all_inputs(cell_input_id, value_id)
+
+        num_state_outputs = len(loop_props.state_outputs)
+        cell_outputs = loop_props.state_outputs + loop_props.scan_outputs
+        for index, exit_ids in enumerate(self._get_exit_ids(loop_props)):
+            if not exit_ids:
+                continue
+            output_id = cell_inputs.get(cell_outputs[index].id, cell_outputs[index].id)
+            if index >= num_state_outputs:
+                output_id = gb.make_unsqueeze({"data": output_id, "axes": [0]})
+            for exit_id in exit_ids:
+                self.g.replace_all_inputs(exit_id, output_id)
+
+    @staticmethod
+    def _get_exit_ids(loop_props):
+        """Return the exit ids to connect to each state output then each scan output.
+        The last element read from a tensor array is the final value of its equivalent state variable,
+        so such a read is connected to the same output as that variable.
+        """
+        state_variables = list(loop_props.state_variables.values())
+        exit_ids = [[exit_output.id] if exit_output.id else []
+                    for exit_output in loop_props.state_outputs_exits + loop_props.scan_outputs_exits]
+        for unneeded_scan_variable in loop_props.unneeded_scan_variables.values():
+            index = state_variables.index(unneeded_scan_variable.equivalent_state_variable)
+            exit_ids[index].append(unneeded_scan_variable.exit_output.id)
+        return exit_ids
+
+    def _hoist_scan_input_projections(self, context, body_g):
+        """If a scan input is only consumed by MatMul(x_t, W) with a const W, optionally followed
+        by a bias add with a const bias, the per-step projection is computed for the whole sequence
+        before Scan, and its result is scanned instead of x_t.
+        """
+        for input_ta in context.loop_properties.tensor_array_inputs:
+            x_t_id = input_ta.consumer.id
+            consumers = body_g.find_output_consumers(x_t_id)
+            if len(consumers) != 1:
+                continue
+            matmul_node = consumers[0]
+            if matmul_node.type != "MatMul" or matmul_node.input[0] != x_t_id or \
+                    matmul_node.get_attr_value("transpose_a") or matmul_node.get_attr_value("transpose_b"):
+                continue
+            weight_id = matmul_node.input[1]
+            if not self._is_outer_const(weight_id):
+                continue
+
+            data_shape = self.g.get_shape(input_ta.data_input_id)
+            weight_shape = self.g.get_shape(weight_id)
+            projected_shape = None
+            if data_shape is not None and weight_shape is not None:
+                projected_shape = data_shape[:-1] + weight_shape[-1:]
+            dtype = body_g.get_dtype(matmul_node.output[0])
+            projected_node = self.g.make_node("MatMul", [input_ta.data_input_id, weight_id],
+                                              op_name_scope="custom_rnn_input_projection",
+                                              shapes=[projected_shape], dtypes=[dtype])
+            hoisted_nodes = [matmul_node]
+
+            bias_node = self._get_hoistable_bias_add(body_g, matmul_node)
+            if bias_node:
+                bias_id = [i for i in bias_node.input if i != matmul_node.output[0]][0]
+                projected_node = self.g.make_node("Add", [projected_node.output[0], bias_id],
+                                                  op_name_scope="custom_rnn_input_projection",
+                                                  shapes=[projected_shape], dtypes=[dtype])
+                hoisted_nodes.append(bias_node)
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("hoist %s out of scan body as %s", [n.name for n in hoisted_nodes], projected_node.name)
+            # the last hoisted output becomes the body input fed by the scanned projection
+            input_ta.data_input_id = projected_node.output[0]
+            input_ta.consumer = TensorValueInfo(hoisted_nodes[-1].output[0], body_g)
+            for n in hoisted_nodes:
+                body_g.remove_node(n.name)
+
+    def _get_hoistable_bias_add(self, body_g, matmul_node):
+        consumers = body_g.find_output_consumers(matmul_node.output[0])
+        if len(consumers) != 1 or consumers[0].type not in ["Add", "AddV2", "BiasAdd"]:
+            return None
+        add_node = consumers[0]
+        if add_node.type == "BiasAdd" and add_node.get_attr_value("data_format", b"NHWC") != b"NHWC":
+            return None
+        other_inputs = [i for i in add_node.input if i != matmul_node.output[0]]
+        if len(add_node.input) != 2 or len(other_inputs) != 1 or not self._is_outer_const(other_inputs[0]):
+            return None
+        # the bias must not broadcast the projection to a larger shape
+        projection_shape = body_g.get_shape(matmul_node.output[0])
+        if projection_shape is None or body_g.get_shape(add_node.output[0]) != projection_shape:
+            return None
+        return add_node
+
+    def _is_outer_const(self, tensor_id):
+        node = self.g.get_node_by_output(tensor_id)
+        return node is not None and node.is_const()
+
+    def _fold_seq_len_check(self, context, body_g, scan_length):
+        """dynamic_rnn with sequence_length selects between the cell output and a copy by
+        GreaterEqual(time, sequence_length) in every step. If time goes from a const by 1 and the
+        static scan length keeps it below the const sequence_length, the check is always False,
+        so fold the Select ops to the cell output and drop the check from the body.
+        """
+        time_var = context.time_var
+        time_input_id = time_var.switch_true_identity_output.id
+        if scan_length == -1 or not time_input_id:
+            return
+
+        time_init_node = self.g.get_node_by_output(time_var.enter_input_id)
+        time_next_node = body_g.get_node_by_output(time_var.next_iteration_input.id)
+        if not time_init_node or not time_init_node.is_const() or \
+                not time_next_node or time_next_node.type not in ["Add", "AddV2"]:
+            return
+        step_ids = [i for i in time_next_node.input if i != time_input_id]
+        if len(step_ids) != 1 or len(time_next_node.input) != 2:
+            return
+        step_node = self.g.get_node_by_output(step_ids[0])
+        if not step_node or not step_node.is_const() or step_node.get_tensor_value() != 1:
+            return
+        max_time = time_init_node.get_tensor_value() + scan_length - 1
+
+        # nodes are removed from body_g while iterating, so iterate over a copy
+        for node in list(body_g.get_nodes()):
+            if node.type != "GreaterEqual" or node.input[0] != time_input_id:
+                continue
+            seq_len_node = self.g.get_node_by_output(node.input[1])
+            if not seq_len_node or not seq_len_node.is_const():
+                continue
+            seq_len = seq_len_node.get_tensor_value(as_list=False)
+            if seq_len.size == 0:
+                continue
+            min_seq_len = seq_len.min()
+            if min_seq_len <= max_time:
+                continue
+
+            logger.debug("fold sequence length check %s, time never reaches %s", node.name, min_seq_len)
+            for select_node in body_g.find_output_consumers(node.output[0]):
+                if select_node.type in ["Select", "SelectV2"] and select_node.input[0] == node.output[0]:
+                    body_g.replace_all_inputs(select_node.output[0], select_node.input[2])
+                    body_g.remove_node(select_node.name)
+            if not body_g.find_output_consumers(node.output[0]):
+                body_g.remove_node(node.name)
+
     def _create_scan_node(self, context, scan_props, init_values, body_g, scan_length):
         logger.debug("create scan node")
         branches = {"body": body_g}
-        # reuse original output connection id (e.g. Exit_XXX), so we don't need set shape.
+        # Exit nodes are kept, their consumers are rewired to the scan outputs in _connect_scan_with_output
+        # and the unused ones are deleted together once all loops are rewritten.
         loop_outputs_shapes = []
         loop_outputs_dtypes = []
 
@@ -151,83 +319,91 @@ class CustomRnnRewriter(LoopRewriterBase):
     def _connect_scan_with_output(self, context, scan_node):
         logger.debug("connect scan output with the graph")
 
-        index = 0
-        for out_tensor_value_info in context.loop_properties.state_outputs_exits:
-            if out_tensor_value_info.id:
-                if self.g.opset == 8:
-                    nodes = self._adapt_scan_sequence_input_or_output("state_output_reshape",
-                                                                      scan_node.output[index], True)
-                    self.g.replace_all_inputs(
-                        out_tensor_value_info.id, nodes[-1].output[0])  # ops=self.g.get_nodes()
-                else:  # since opset 9
-                    self.g.replace_all_inputs(
-                        out_tensor_value_info.id, scan_node.output[index])  # ops=self.g.get_nodes()
-            index += 1
-
-        for out_tensor_value_info in context.loop_properties.scan_outputs_exits:
-            if out_tensor_value_info.id:
-                if self.g.opset == 8:
-                    nodes = self._adapt_scan_sequence_input_or_output("scan_output_reshape",
-                                                                      scan_node.output[index], True)
-                    self.g.replace_all_inputs(
-                        out_tensor_value_info.id, nodes[-1].output[0])  # ops=self.g.get_nodes()
-                else:  # since opset 9
-                    self.g.replace_all_inputs(
-                        out_tensor_value_info.id, scan_node.output[index])  # ops=self.g.get_nodes()
-            index += 1
+        loop_props = context.loop_properties
+        num_state_outputs = len(loop_props.state_outputs_exits)
+        scan_outputs = scan_node.output
+        is_opset_8 = self.g.opset == 8
+        for index, exit_ids in enumerate(self._get_exit_ids(loop_props)):
+            if not exit_ids:
+                continue
+            if is_opset_8:
+                target_name = "state_output_reshape" if index < num_state_outputs else "scan_output_reshape"
+                output_id = self._adapt_scan_sequence_input_or_output(target_name, scan_outputs[index], True).output[0]
+            else:  # since opset 9
+                output_id = scan_outputs[index]
+            for exit_id in exit_ids:
+                self.g.replace_all_inputs(exit_id, output_id)  # ops=self.g.get_nodes()
 
     def _adapt_scan_sequence_input_or_output(self, target_name, input_id, handle_output=False):
-        nodes_to_add = []
-        shape_node = self.g.make_node("Shape", [input_id])
-        nodes_to_add.append(shape_node)
-        inferred_shape = self.g.get_shape(input_id)
-        if handle_output is True:
-            # handle output:
-            # if required dim values don't contain more than one -1,
-            # just use a const for Reshape's shape input.
-            if inferred_shape is not None and inferred_shape[1:].count(-1) <= 1:
-                new_shape_node = self.g.make_const(utils.make_name(target_name + "_target_shape"),
-                                                   np.array(inferred_shape[1:], dtype=np.int64))
-                nodes_to_add.append(new_shape_node)
-            else:
-                # otherwise, get the dim dynamically, e.g. remove the fake batch size (e.g.1)
-                # from [1, time, real-batch, ...]
-                origin_shape_node = self.g.make_node("Cast", [shape_node.output[0]],
-                                                     {"to": onnx_pb.TensorProto.FLOAT})
-                nodes_to_add.append(origin_shape_node)
-
-                attr = {"axes": [0], "starts": [1], "ends": [sys.maxsize]}
-                inputs_map = {"data": origin_shape_node.output[0], **attr}
-                sliced_shape_node = GraphBuilder(self.g).make_slice(inputs_map)
-                nodes_to_add.append(self.g.get_node_by_output(sliced_shape_node))
-
-                new_shape_node = self.g.make_node("Cast", [sliced_shape_node],
-                                                  {"to": onnx_pb.TensorProto.INT64})
-                nodes_to_add.append(new_shape_node)
+        """Return the node adding (input) or removing (output) the fake batch size of opset 8 Scan."""
+        if handle_output is False:
+            input_node = self.g.get_node_by_output(input_id)
+            if input_node and input_node.is_const():
+                # e.g. initial time or zero state, the fake batch size is added to the value itself
+                # so no Shape/Reshape needs to run in the graph.
+                value = input_node.get_tensor_value(as_list=False)
+                const_node = self.g.make_const(utils.make_name(target_name), np.expand_dims(value, 0))
+                logger.debug("create Const %s for scan input %s", const_node.output[0], input_id)
+                return const_node
 
+        inferred_shape = self.g.get_shape(input_id)
+        dtype = self.g.get_dtype(input_id)
+        if inferred_shape is None:
+            new_shape = None
+        elif handle_output is True:
+            # remove the fake batch size (e.g.1) from [1, time, real-batch, ...]
             new_shape = inferred_shape[1:]
         else:
-            # handle input:
-            if inferred_shape is not None and inferred_shape.count(-1) <= 1:
-                new_shape_node = self.g.make_const(utils.make_name(target_name + "_target_shape"),
-                                                   np.array([1] + inferred_shape, dtype=np.int64))
-                nodes_to_add.append(new_shape_node)
-            else:
-                # add a fake batch size : 1
-                fake_batch_size_node = self.g.make_const(utils.make_name(target_name + "_target_shape"),
-                                                         np.array([1], dtype=np.int64))
-                nodes_to_add.append(fake_batch_size_node)
-                new_shape_node = self.g.make_node("Concat",
-                                                  [fake_batch_size_node.output[0], shape_node.output[0]],
-                                                  attr={"axis": 0})
-                nodes_to_add.append(new_shape_node)
+            # add a fake batch size : 1
             new_shape = [1] + inferred_shape
 
-        reshape_node = self.g.make_node("Reshape", [input_id, new_shape_node.output[0]],
-                                        shapes=[new_shape],
-                                        dtypes=[self.g.get_dtype(input_id)],
-                                        op_name_scope=target_name)
-        nodes_to_add.append(reshape_node)
-        logger.debug("create Reshape for scan output %s, with output shape %s",
-                     reshape_node.output[0], new_shape)
-        return nodes_to_add
+        # shapes and dtypes of the helper nodes are given explicitly, so that make_node
+        # doesn't need to run onnx shape inference for each of them.
+        rank = len(inferred_shape) if inferred_shape is not None else -1
+        new_rank = len(new_shape) if new_shape is not None else -1
+        new_shape_node = None
+        # if required dim values don't contain more than one -1, the fake batch size
+        # is just squeezed/unsqueezed, otherwise the target shape of Reshape is built dynamically.
+        if new_shape is None or new_shape.count(-1) > 1:
+            shape_out = self.g.make_node("Shape", [input_id], shapes=[[rank]],
+                                         dtypes=[onnx_pb.TensorProto.INT64]).output[0]
+            if handle_output is True:
+                # Slice accepts the int64 shape directly.
+                attr = {"axes": [0], "starts": [1], "ends": [sys.maxsize]}
+                inputs_map = {"data": shape_out, **attr}
+                new_shape_node = GraphBuilder(self.g).make_slice(inputs_map, shapes=[[new_rank]],
+                                                                 dtypes=[onnx_pb.TensorProto.INT64],
+                                                                 return_node=True)
+            else:
+                fake_batch_size_node = self._make_shape_const(target_name, [1])
+                new_shape_node = self.g.make_node("Concat",
+                                                  [fake_batch_size_node.output[0], shape_out],
+                                                  attr={"axis": 0}, shapes=[[new_rank]],
+                                                  dtypes=[onnx_pb.TensorProto.INT64])
+
+        if new_shape_node is None:
+            # Squeeze/Unsqueeze on axis 0 is what the Reshape would do, and is easier for runtimes to fold
+            inputs_map = {"data": input_id, "axes": [0]}
+            if handle_output is True:
+                adapt_node = GraphBuilder(self.g).make_squeeze(inputs_map, shapes=[new_shape], dtypes=[dtype],
+                                                               return_node=True, op_name_scope=target_name)
+            else:
+                adapt_node = GraphBuilder(self.g).make_unsqueeze(inputs_map, shapes=[new_shape], dtypes=[dtype],
+                                                                 return_node=True, op_name_scope=target_name)
+        else:
+            adapt_node = self.g.make_node("Reshape", [input_id, new_shape_node.output[0]],
+                                          shapes=[new_shape],
+                                          dtypes=[dtype],
+                                          op_name_scope=target_name)
+        logger.debug("create %s for scan output %s, with output shape %s",
+                     adapt_node.type, adapt_node.output[0], new_shape)
+        return adapt_node
+
+    def _make_shape_const(self, target_name, shape):
+        key = tuple(shape)
+        const_node = self._shape_const_cache.get(key)
+        if const_node is None:
+            const_node = self.g.make_const(utils.make_name(target_name + "_target_shape"),
+                                           np.array(shape, dtype=np.int64))
+            self._shape_const_cache[key] = const_node
+        return const_node
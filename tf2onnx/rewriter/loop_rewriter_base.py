@@ -173,6 +173,10 @@ class LoopVariable(object):
         # then we can be sure this is equivalent to scan output behavior.
         self.ta_index_id = ta_index_id
 
+        # only applicable for tensor array only read for its last element, the state variable
+        # getting the same value written into the tensor array in each iteration, if any.
+        self.equivalent_state_variable = None
+
 
 class InputTensorArray(object):
     def __init__(self, data_input_id, index_input_id, consumer_id, g):
@@ -287,8 +291,12 @@ class LoopRewriterBase(object):
     def _parse_input_ta(self, context):
         graph_inputs = [v.switch_true_identity_output.id for v in context.loop_properties.all_variables.values()
                         if v.switch_true_identity_output.id]
+        # the index of a matched read is one of the loop inputs, so their consumers are the only
+        # candidates, no need to match the whole graph again for each loop.
+        ta_read_nodes = {n for graph_input in graph_inputs for n in self.g.find_output_consumers(graph_input)
+                         if is_tf_tensor_array_read_op(n)}
         matcher = GraphMatcher(self.ta_read_input_pattern, allow_reorder=False)
-        match_results = matcher.match_ops(self.g.get_nodes())
+        match_results = matcher.match_ops(sorted(ta_read_nodes, key=lambda n: n.name))
         match_results = [r for r in match_results if r.get_op("ta_index").output[0] in graph_inputs]
         for match in match_results:
             ta_input_scatter = match.get_op("ta_input_scatter")
@@ -356,13 +364,15 @@ class LoopRewriterBase(object):
                 n = self.g.get_node_by_output(val.switch_true_identity_output.id)
                 self.g.remove_node(n.name)
 
+            # only consumers of the cell output can reference it, no need to scan the whole graph.
+            cell_output_consumers = self.g.find_output_consumers(val.next_iteration_input.id)
             if val.tensor_array_type == TensorArrayVariableType.GATHER_ALL:
                 # connect NextIteration to an invalid node, to cut off an ending node of the cell.
-                ta_write_nodes = [n for n in self.g.get_nodes() if is_tf_tensor_array_write_op(n)]
+                ta_write_nodes = [n for n in cell_output_consumers if is_tf_tensor_array_write_op(n)]
                 self.g.replace_all_inputs(val.next_iteration_input.id, INVALID_INPUT_ID, ops=ta_write_nodes)
             else:
                 # connect NextIteration to an invalid node, to cut off an ending node of the cell.
-                next_iter_nodes = [n for n in self.g.get_nodes() if n.type == "NextIteration"]
+                next_iter_nodes = [n for n in cell_output_consumers if n.type == "NextIteration"]
                 self.g.replace_all_inputs(val.next_iteration_input.id, INVALID_INPUT_ID, ops=next_iter_nodes)
 
         for scan_input in context.loop_properties.scan_inputs:
@@ -400,7 +410,8 @@ class LoopRewriterBase(object):
             for n in switch_consumers:
                 for i, nn in enumerate(n.input):
                     if nn == switch_node.output[1]:
-                        n.input[i] = switch_true_identity_output
+                        # keep the consumer index up to date, later lookups of the identity's consumers rely on it
+                        self.g.replace_input(n, nn, switch_true_identity_output, i)
 
         target_node_input_id = None
         enter_node = [n for n in merge_node.inputs if n.type == 'Enter'][0]
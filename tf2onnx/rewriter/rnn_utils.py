@@ -7,6 +7,7 @@ tf2onnx.rewriter.rnn_utils - rnn support
 
 from collections import defaultdict
 from enum import Enum
+from functools import lru_cache
 
 import logging
 import numpy as np
@@ -379,6 +380,8 @@ def get_pattern(cell_type_name):
     return rnn_cell_patterns[cell_type_name]
 
 
+# every rnn rewriter asks for the scope of the same while loops
+@lru_cache(maxsize=1024)
 def get_rnn_scope_name(while_scope_name):
     parts = while_scope_name.split('/')
     rnn_scope = '/'.join(parts[0:-2]) + "/"
@@ -411,29 +414,29 @@ def parse_rnn_loop(graph, loop_properties, rnn_scope, while_context_scope):
     ta_array_name_prefix = rnn_scope + "dynamic_rnn/output_"
     iteration_counter_name = while_context_scope + "iteration_counter"
 
-    found_time = False
-    is_rnn_out_ta = None
+    if not loop_properties.tensor_array_inputs:
+        logger.debug("this should not be a dynamic_rnn loop, no ta input is found")
+        return None
+
     time_var = None
     iteration_var = None
+    get_node_by_output = graph.get_node_by_output
+    gather_all = TensorArrayVariableType.GATHER_ALL
     for val in loop_properties.all_variables.values():
-        enter_input_node = graph.get_node_by_output(val.enter_input_id)
-        if val.tensor_array_type == TensorArrayVariableType.GATHER_ALL:
+        enter_input_node = get_node_by_output(val.enter_input_id)
+        if val.tensor_array_type == gather_all:
             ta_name = enter_input_node.get_attr("tensor_array_name").s.decode("utf-8")
             if not ta_name.startswith(ta_array_name_prefix):
-                is_rnn_out_ta = False
+                # a single foreign output tensor array rules the loop out, no need to check the rest
+                logger.debug("this should not be a dynamic_rnn loop, output ta %s is not from dynamic_rnn", ta_name)
+                return None
         elif enter_input_node.name == time_name:
-            found_time = True
             time_var = val
         elif enter_input_node.name == iteration_counter_name:
             iteration_var = val
 
-    if not found_time or is_rnn_out_ta is False:
-        logger.debug("this should not be a dynamic_rnn loop, found_time: %s, is_rnn_out_ta: %s",
-                     found_time, is_rnn_out_ta)
-        return None
-
-    if not loop_properties.tensor_array_inputs:
-        logger.debug("this should not be a dynamic_rnn loop, no ta input is found")
+    if time_var is None:
+        logger.debug("this should not be a dynamic_rnn loop, time var is not found")
         return None
 
     return time_var, iteration_var
@@ -602,6 +602,9 @@ def process_parsed_graph(g, custom_op_handlers, inputs_as_nchw, outputs_as_nchw,
         rewrite_bi_direction_lstm,
         rewrite_single_direction_gru,
         rewrite_bi_direction_gru,
+        # loops matching a canonical LSTM/GRU cell are converted to native ONNX ops above,
+        # the custom rnn rewriter only emits Scan for the remaining dynamic_rnn loops, it must run before
+        # the generic loop rewriter since Scan is better optimized than Loop by runtimes
         rewrite_custom_rnn_cell,
         rewrite_generic_loop, rewrite_cond,
         rewrite_biasadd_with_conv2d,